@@ -1,4 +1,3 @@
-import math
 from pathlib import Path
 
 import numpy as np
@@ -20,31 +19,43 @@ class TokenDataset(IterableDataset):
         self.shards = sorted(Path(dataset_dir).glob("*.bin"))
         self.seq_len = seq_len
         self.eval = eval
+        self.seed = seed
         print(f"Found {len(self.shards)} shards of data")
 
         # TODO: load and save state_dict
         self._generator = torch.Generator().manual_seed(seed)
 
     def _iter_shard(self, shard: Tensor):
-        n_slices = math.floor(shard.shape[0] / (self.seq_len + 1))
-        slice_indices = range(n_slices) if self.eval else torch.randperm(n_slices)
+        # view the shard as (n_slices, seq_len + 1) once instead of computing slice offsets per sample
+        n_slices = shard.shape[0] // (self.seq_len + 1)
+        slices = shard[: n_slices * (self.seq_len + 1)].view(n_slices, self.seq_len + 1)
+        slice_indices = range(n_slices) if self.eval else torch.randperm(n_slices, generator=self._generator)
 
         for slice_idx in slice_indices:
-            batch = shard[slice_idx * (self.seq_len + 1) : (slice_idx + 1) * (self.seq_len + 1)]
-            yield batch[:-1].long(), batch[1:].long()
+            # cast once. tokens and labels are overlapping views into the same buffer.
+            # keep int32 so H2D transfer moves 4 bytes/token instead of 8. F.embedding accepts
+            # int32 indices, and the loss fn upcasts labels to int64 on-device.
+            batch = slices[slice_idx].to(torch.int32)
+            yield batch[:-1], batch[1:]
 
     def __iter__(self):
+        # split shards among (rank, worker) pairs so each worker reads a disjoint subset.
+        # reseed so the shard order also differs across workers.
+        rank, world_size = _get_dist_info(include_worker_info=True)
+        shards = self.shards[rank::world_size]
+        # fail loudly instead of busy-spinning on an empty shard list
+        assert len(shards) > 0, f"{len(self.shards)} shard(s) cannot be split among {world_size} workers"
+        self._generator.manual_seed(self.seed + rank)
+
         while True:
-            # NOTE: we don't split data across workers. just depend on workers having different
-            # random seeds to select different slice of data.
             if self.eval:
-                shard_indices = range(len(self.shards))
+                shard_indices = range(len(shards))
             else:
-                shard_indices = torch.randperm(len(self.shards), generator=self._generator)
+                shard_indices = torch.randperm(len(shards), generator=self._generator)
 
             for shard_idx in shard_indices:
                 # divide a shard into n slices of (seq_len + 1)
-                shard_np = np.memmap(self.shards[shard_idx], dtype=np.uint16, mode="r")
+                shard_np = np.memmap(shards[shard_idx], dtype=np.uint16, mode="r")
                 shard = torch.from_numpy(shard_np)
 
                 for data in self._iter_shard(shard):
@@ -1,4 +1,5 @@
 import re
+from functools import lru_cache
 
 import torch
 import torch.nn.functional as F
@@ -25,26 +26,27 @@ def predict(model: LlamaForCausalLM, data: Tensor) -> Tensor:
     N, n_choices, seq_len = data.shape
 
     inputs = data[..., :-1].reshape(N * n_choices, seq_len - 1)
-    logits = model(inputs).logits.float()  # (N * n_choices, seq_len - 1, vocab_size)
+    # call trunk + lm_head directly to avoid the CausalLMOutput boundary, which breaks
+    # the torch.compile graph
+    logits = model.lm_head(model.model(inputs)[0]).float()  # (N * n_choices, seq_len - 1, vocab_size)
 
-    labels = data[..., 1:]  # (N, n_choices, seq_len - 1)
-    loss = F.cross_entropy(logits.view(-1, logits.shape[-1]), labels.flatten(), reduction="none")
+    labels = data[..., 1:].reshape(N * n_choices, seq_len - 1)
+    # cross_entropy handles (N, C, d1) directly - no need to flatten logits
+    loss = F.cross_entropy(logits.transpose(1, 2), labels, reduction="none")
 
-    loss = loss.reshape(N, n_choices, seq_len - 1).sum(-1)
+    loss = loss.view(N, n_choices, seq_len - 1).sum(-1)
     preds = loss.argmin(-1)
     return preds
 
 
-# NOTE: this probably will not agree with lm_eval results.
-# it's mainly to avoid recompiles for validation during training.
-@torch.no_grad()
-def evaluate_hellaswag(model: LlamaForCausalLM, tokenizer: str, split: str = "validation", pbar: bool = True) -> None:
+# cache so repeated validation during training doesn't reload + retokenize the dataset
+@lru_cache(maxsize=1)
+def _load_hellaswag(tokenizer: str, split: str) -> tuple[Tensor, Tensor]:
     # using Llama2 tokenizer, max 170 toks
     ds = load_dataset("Rowan/hellaswag", split=split)
     tokens = torch.zeros(len(ds), 4, 193, dtype=torch.int64)
     tokenizer = get_tokenizer(tokenizer)
 
-    # TODO: cache this
     for row_idx, row in enumerate(ds):
         ctx = f"{row['activity_label']}: {row['ctx_a']} {row['ctx_b'].capitalize()}"
         for ending_idx, ending in enumerate(row["endings"]):
@@ -53,17 +55,32 @@ def evaluate_hellaswag(model: LlamaForCausalLM, tokenizer: str, split: str = "va
             tokens[row_idx, ending_idx, : len(toks)] = torch.tensor(toks)
             tokens[row_idx, ending_idx, len(toks) :] = -100
 
+    all_labels = torch.tensor([int(x) for x in ds["label"]])
+    return tokens, all_labels
+
+
+# NOTE: this probably will not agree with lm_eval results.
+# it's mainly to avoid recompiles for validation during training.
+@torch.no_grad()
+def evaluate_hellaswag(model: LlamaForCausalLM, tokenizer: str, split: str = "validation", pbar: bool = True) -> None:
+    tokens, all_labels = _load_hellaswag(tokenizer, split)
+    all_labels = all_labels.cuda()
+
     # TODO: distributed inference
-    n_correct = 0
+    # accumulate on-device, sync once at the end instead of once per batch
+    n_correct = torch.zeros((), dtype=torch.int64, device="cuda")
     bsize = 2
-    all_labels = torch.tensor([int(x) for x in ds["label"]])
     model.eval()
-    for i in tqdm(range(0, len(ds), bsize), desc=f"Evaluate hellaswag {split}", disable=not pbar, dynamic_ncols=True):
-        end_idx = min(i + bsize, len(ds))
+    # forward-only with fixed shapes - worth autotuning kernel choices. skip CUDA graphs
+    # since the model is shared with training.
+    predict_fn = torch.compile(predict, mode="max-autotune-no-cudagraphs")
+    n_samples = tokens.shape[0]
+    for i in tqdm(range(0, n_samples, bsize), desc=f"Evaluate hellaswag {split}", disable=not pbar, dynamic_ncols=True):
+        end_idx = min(i + bsize, n_samples)
         data = tokens[i:end_idx]
         labels = all_labels[i:end_idx]
 
-        preds = torch.compile(predict)(model, data.cuda())
-        n_correct += (preds.cpu() == labels).sum().item()
+        preds = predict_fn(model, data.cuda())
+        n_correct += (preds == labels).sum()
 
-    return n_correct / len(ds)
+    return n_correct.item() / n_samples
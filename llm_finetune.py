@@ -9,6 +9,7 @@ from datetime import datetime
 from pathlib import Path
 
 import torch
+import torch.nn.functional as F
 import wandb
 from datasets import load_dataset
 from torch import Tensor
@@ -59,7 +60,12 @@ def get_metamathqa(tokenizer_id: str, batch_size: int, max_seq_len: int, seq_len
 
 
 def get_loss(model, inputs, labels):
-    return model(inputs, labels=labels).loss
+    # call the trunk + lm_head directly instead of the HF forward: skips the built-in loss
+    # path and the CausalLMOutput construction, which cause graph breaks under torch.compile.
+    # same next-token shift as the HF loss. slicing hidden also skips lm_head on the last pos.
+    hidden = model.model(inputs)[0]
+    logits = model.lm_head(hidden[:, :-1]).float()
+    return F.cross_entropy(logits.transpose(1, 2), labels[:, 1:])
 
 
 if __name__ == "__main__":
@@ -77,7 +83,7 @@ if __name__ == "__main__":
     parser.add_argument("--batch_size", type=int, default=1)
     parser.add_argument("--n_steps", type=int, default=1000)
 
-    parser.add_argument("--optim", default="optimizers.AdamW")
+    parser.add_argument("--optim", default="torch.optim.AdamW")
     parser.add_argument("--lr", type=float, default=1e-4)
     parser.add_argument("--weight_decay", type=float, default=0)
     parser.add_argument("--optim_kwargs", type=json.loads, default=dict())
@@ -128,24 +134,24 @@ if __name__ == "__main__":
     log_interval = 50
     pbar = tqdm(total=args.n_steps, dynamic_ncols=True)
     model.train()
+    loss_fn = torch.compile(get_loss, fullgraph=True) if args.compile else get_loss
 
     while step < args.n_steps:
         inputs, labels = next(train_data_iter)
-        loss_fn = torch.compile(get_loss, fullgraph=True) if args.compile else get_loss
         loss = loss_fn(model, inputs, labels)
         loss.backward()
 
         if step % log_interval == 0:
             log_dict = dict(
                 loss=loss.item(),
-                grad_norm=get_grad_norm(model),
+                grad_norm=get_grad_norm(model).item(),
                 lr=optim.param_groups[0]["lr"],
             )
             run.log(log_dict, step=step)
             pbar.set_postfix(loss=log_dict["loss"])
 
         optim.step()
-        optim.zero_grad()
+        optim.zero_grad(set_to_none=True)
 
         step += 1
         pbar.update()
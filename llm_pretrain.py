@@ -7,6 +7,7 @@ os.environ["PYTORCH_CUDA_ALLOC_CONF"] = "expandable_segments:True"
 import argparse
 import json
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 
@@ -24,16 +25,42 @@ from transformers.models.llama.modeling_llama import LlamaRMSNorm
 
 from data import ShuffleDataset, get_dataset
 from hellaswag import evaluate_hellaswag
-from train_utils import LRSchedule, get_grad_norm, get_optimizer, print_model_stats, quantize_model
+from train_utils import CudaPrefetcher, LRSchedule, get_grad_norm, get_optimizer, print_model_stats, quantize_model
+
+# model is BF16, but stray FP32 ops (e.g. softmax upcast) can still hit matmuls.
+# "high" allows TF32 for those instead of the (much slower) IEEE FP32 path.
+torch.set_float32_matmul_precision("high")
+torch.backends.cudnn.allow_tf32 = True
 
 
 def get_loss(model: LlamaForCausalLM, tokens: Tensor, labels: Tensor):
-    # last_hidden_state = model.model(tokens)[0]
-    # last_hidden_state = last_hidden_state.view(-1, last_hidden_state.shape[-1])
-    # logits = model.lm_head(last_hidden_state).float()
-    # return F.cross_entropy(logits, labels.view(-1))
-    logits = model(tokens).logits.float()
-    return F.cross_entropy(logits.view(-1, logits.shape[-1]), labels.long().view(-1))
+    logits = model(tokens).logits.float()  # (B, S, vocab_size)
+    # cross_entropy handles (N, C, d1) directly. transpose is a stride change, no copy.
+    return F.cross_entropy(logits.transpose(1, 2), labels.long())
+
+
+def get_loss_chunked(model: LlamaForCausalLM, tokens: Tensor, labels: Tensor, chunk_size: int = 8192):
+    # chunk lm_head + CE so the full (B * S, vocab_size) FP32 logits are never materialized
+    # (~1 GB at B=4, S=2048, vocab=32000). under torch.compile, inductor fuses
+    # lm_head + softmax + NLL per chunk. calling model.model / model.lm_head directly
+    # bypasses DDP/FSDP root-module hooks, so this is single-device only.
+    hidden = model.model(tokens)[0].flatten(0, 1)
+    labels = labels.long().flatten()
+    loss = hidden.new_zeros((), dtype=torch.float32)
+    for i in range(0, hidden.shape[0], chunk_size):
+        logits = model.lm_head(hidden[i : i + chunk_size]).float()
+        loss = loss + F.cross_entropy(logits, labels[i : i + chunk_size], reduction="sum")
+    return loss / labels.shape[0]
+
+
+def to_cpu(obj):
+    if isinstance(obj, Tensor):
+        return obj.to("cpu", non_blocking=True)
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(x) for x in obj)
+    return obj
 
 
 if __name__ == "__main__":
@@ -58,6 +85,7 @@ if __name__ == "__main__":
     parser.add_argument("--lr", type=float, default=3e-4)
     parser.add_argument("--weight_decay", type=float, default=1e-2)
     parser.add_argument("--optim_kwargs", type=json.loads, default=dict())
+    parser.add_argument("--optim_cuda_graph", action="store_true")
     parser.add_argument("--lr_schedule_kwargs", type=json.loads)
     parser.add_argument("--clip_grad_norm", type=int)
 
@@ -141,7 +169,17 @@ if __name__ == "__main__":
     if is_master:
         print_model_stats(model)
 
-    optim = get_optimizer(args.optim, model, args.lr, args.weight_decay, **args.optim_kwargs)
+    if args.optim in ("torch.optim.Adam", "torch.optim.AdamW") and args.quantize is None:
+        # fused step is one kernel across all params, but only works on plain tensors -
+        # the quantized subclasses raise NotImplementedError on the fused ops
+        args.optim_kwargs.setdefault("fused", True)
+    if args.optim_cuda_graph:
+        # capturable=True makes the optimizer read hyperparams from device tensors inside the
+        # graph, and the LR must be a CUDA tensor so LRSchedule updates are seen by replays.
+        assert not is_fsdp, "FSDP reallocates sharded grads every step, not CUDA-graph safe"
+        args.optim_kwargs.setdefault("capturable", True)
+    lr = torch.tensor(args.lr, device="cuda") if args.optim_cuda_graph else args.lr
+    optim = get_optimizer(args.optim, model, lr, args.weight_decay, **args.optim_kwargs)
     if args.lr_schedule_kwargs is not None:
         lr_schedule = LRSchedule(args.lr, args.n_steps, **args.lr_schedule_kwargs)
     else:
@@ -154,7 +192,7 @@ if __name__ == "__main__":
         ds,
         batch_size=bsize,
         num_workers=1,
-        pin_memory=True,
+        pin_memory=False,  # CudaPrefetcher stages batches through its own pinned buffers
         snapshot_every_n_steps=args.ckpt_interval,
     )
 
@@ -175,24 +213,42 @@ if __name__ == "__main__":
         ckpt = torch.load(args.resume, map_location="cpu")
         model.load_state_dict(ckpt["model"])
         optim.load_state_dict(ckpt["optim"])
+        if args.optim_cuda_graph:
+            # map_location="cpu" moved the LR tensor to CPU. the capturable/fused step needs
+            # it on CUDA, and the captured graph only reads the on-device copy.
+            for param_group in optim.param_groups:
+                if isinstance(param_group["lr"], Tensor):
+                    param_group["lr"] = param_group["lr"].cuda()
         dloader.load_state_dict(ckpt["dloader"])
         step = ckpt["step"]
 
+    # serialization to disk happens on a background thread. only the D2H copy of the
+    # state dict stays on the main thread.
+    ckpt_executor = ThreadPoolExecutor(max_workers=1)
+    ckpt_future = None
+
     log_interval = 50
     pbar = tqdm(total=args.n_steps, initial=step, dynamic_ncols=True, disable=is_master == False)
     model.train()
-    loss_fn = get_loss if is_fsdp else torch.compile(get_loss)
+    loss_fn = get_loss if is_dist else get_loss_chunked
+    if not is_fsdp:
+        loss_fn = torch.compile(loss_fn)
     time0 = time.time()
     if args.profile and is_master:
         torch._inductor.config.triton.unique_kernel_names = True
         prof = torch.profiler.profile()
 
-    dloader_iter = iter(dloader)
+    # NOTE: the prefetcher keeps one batch in flight, so dloader.state_dict() at checkpoint
+    # time is one micro-batch ahead of what training consumed and that batch is skipped on
+    # resume. the loader state is opaque from here, so we can't compensate the way
+    # HFTextDataset.state_dict does for its own prefetch.
+    dloader_iter = CudaPrefetcher(dloader)
+    optim_graph = None
     while step < args.n_steps:
         # TODO: disable gradient all-reduce for non-last micro-steps
         for _ in range(args.gradient_accumulation):
             tokens, labels = next(dloader_iter)
-            loss = loss_fn(model, tokens.cuda(), labels.cuda())
+            loss = loss_fn(model, tokens, labels)
             loss.backward()
 
         if lr_schedule is not None:
@@ -208,17 +264,28 @@ if __name__ == "__main__":
         if step % log_interval == 0:
             if is_dist:
                 dist.all_reduce(loss, dist.ReduceOp.AVG)
+            if grad_norm is None:
+                grad_norm = get_grad_norm(model)
             log_dict = dict(
                 loss=loss.item(),
-                grad_norm=grad_norm if grad_norm is not None else get_grad_norm(model),
+                grad_norm=grad_norm.item(),
                 lr=optim.param_groups[0]["lr"],
             )
             if is_master:
                 logger.log(log_dict, step=step)
                 pbar.set_postfix(loss=log_dict["loss"])
 
-        optim.step()
-        optim.zero_grad()
+        if optim_graph is not None:
+            optim_graph.replay()
+        else:
+            optim.step()
+            # capture after a few eager warmup steps, once grads and optim states are allocated
+            if args.optim_cuda_graph and step >= 3:
+                optim_graph = torch.cuda.CUDAGraph()
+                with torch.cuda.graph(optim_graph):
+                    optim.step()
+        # graph replay reads grads at their captured addresses, so they must be zeroed in-place
+        optim.zero_grad(set_to_none=not args.optim_cuda_graph)
 
         step += 1
         pbar.update()
@@ -237,26 +304,35 @@ if __name__ == "__main__":
             logger.log(log_dict, step=step)
 
         if args.ckpt_interval > 0 and step % args.ckpt_interval == 0:
+            if ckpt_future is not None:  # make sure the previous checkpoint finished
+                ckpt_future.result()
+            optim_sd = optim.state_dict()
+            # only the per-param state needs D2H. param_groups holds hyperparams, e.g. the
+            # CUDA LR tensor under --optim_cuda_graph, which must stay on-device.
+            optim_sd["state"] = to_cpu(optim_sd["state"])
             ckpt = dict(
-                model=model.state_dict(),
-                optim=optim.state_dict(),
+                model=to_cpu(model.state_dict()),
+                optim=optim_sd,
                 dloader=dloader.state_dict(),
                 step=step,
             )
+            torch.cuda.synchronize()  # wait for D2H copies before pickling
             if is_fsdp:  # FSDP saves on all ranks
-                torch.save(ckpt, args.save_dir / f"last_{rank}.pth")
+                ckpt_future = ckpt_executor.submit(torch.save, ckpt, args.save_dir / f"last_{rank}.pth")
             elif is_master:  # single-device or DDP - only rank 0
-                torch.save(ckpt, args.save_dir / "last.pth")
+                ckpt_future = ckpt_executor.submit(torch.save, ckpt, args.save_dir / "last.pth")
 
         if args.hellaswag and step % args.hellaswag_interval == 0:
             if is_master:
-                acc = evaluate_hellaswag(model, args.hellaswag_tokenizer)
+                # predict calls model.model / model.lm_head, which DDP doesn't proxy
+                acc = evaluate_hellaswag(model.module if is_ddp else model, args.hellaswag_tokenizer)
                 logger.log(dict(hellaswag_acc=acc), step=step)
 
             if is_dist:
                 dist.barrier()
             model.train()
 
+    ckpt_executor.shutdown(wait=True)
     if is_master:
         logger.finish()
         if args.profile:
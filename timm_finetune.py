@@ -51,7 +51,7 @@ def get_parser():
     parser.add_argument("--n_workers", type=int, default=4)
     parser.add_argument("--limit_steps", type=int, default=0)
 
-    parser.add_argument("--optim", default="optimizers.AdamW")
+    parser.add_argument("--optim", default="torch.optim.AdamW")
     parser.add_argument("--lr", type=float, default=1e-4)
     parser.add_argument("--weight_decay", type=float, default=0)
     parser.add_argument("--optim_kwargs", type=json.loads, default=dict())
@@ -106,11 +106,12 @@ def evaluate_model(model, args):
     all_labels = []
     all_preds = []
 
+    predict_fn = torch.compile(model_predict)
     for batch in tqdm(val_dloader, dynamic_ncols=True, desc=f"Evaluating"):
         all_labels.append(batch["label"].clone())
 
         images = batch["image"].to(dtype=torch.bfloat16, device="cuda")
-        all_preds.append(torch.compile(model_predict)(model, images).cpu())
+        all_preds.append(predict_fn(model, images).cpu())
 
     all_labels = torch.cat(all_labels, dim=0)
     all_preds = torch.cat(all_preds, dim=0)
@@ -148,6 +149,7 @@ if __name__ == "__main__":
 
     log_interval = 10
     step = 0
+    loss_fn = torch.compile(model_loss) if args.compile else model_loss
     time0 = time.time()
     if args.profile:
         prof = torch.profiler.profile()
@@ -157,7 +159,6 @@ if __name__ == "__main__":
         pbar = tqdm(dloader, dynamic_ncols=True, desc=f"Epoch {epoch_idx + 1}/{args.n_epochs}")
 
         for batch in pbar:
-            loss_fn = torch.compile(model_loss) if args.compile else model_loss
             loss = loss_fn(model, batch["image"].cuda().bfloat16(), batch["label"].cuda())
             loss.backward()
 
@@ -169,7 +170,7 @@ if __name__ == "__main__":
             if step % log_interval == 0:
                 log_dict = dict(
                     loss=loss.item(),
-                    grad_norm=get_grad_norm(model),
+                    grad_norm=get_grad_norm(model).item(),
                     lr=optim.param_groups[0]["lr"],
                 )
                 if step > 0:
@@ -180,7 +181,7 @@ if __name__ == "__main__":
                 pbar.set_postfix(loss=log_dict["loss"])
 
             optim.step()
-            optim.zero_grad()
+            optim.zero_grad(set_to_none=True)
             step += 1
             if args.profile and step == 1:
                 prof.start()
@@ -62,9 +62,10 @@ def evaluate_model(model, args):
     all_labels = []
     all_preds = []
 
+    predict_fn = torch.compile(model_predict)
     for imgs, labels in tqdm(val_dloader, dynamic_ncols=True, desc=f"Evaluating"):
         all_labels.append(labels.clone())
-        all_preds.append(torch.compile(model_predict)(model, imgs.bfloat16().cuda()).cpu())
+        all_preds.append(predict_fn(model, imgs.bfloat16().cuda()).cpu())
 
     all_labels = torch.cat(all_labels, dim=0)
     all_preds = torch.cat(all_preds, dim=0)
@@ -126,6 +127,7 @@ if __name__ == "__main__":
     log_interval = 10
     step = 0
     pbar = tqdm(total=args.n_steps, dynamic_ncols=True)
+    loss_fn = torch.compile(model_loss)
     time0 = time.time()
     if args.profile:
         torch._inductor.config.triton.unique_kernel_names = True
@@ -133,7 +135,7 @@ if __name__ == "__main__":
 
     while step < args.n_steps:
         imgs, labels = next(dloader_iter)
-        loss = torch.compile(model_loss)(model, imgs.bfloat16().cuda(), labels.cuda())
+        loss = loss_fn(model, imgs.bfloat16().cuda(), labels.cuda())
         loss.backward()
 
         lr_schedule.set_lr(step, optim)
@@ -146,14 +148,14 @@ if __name__ == "__main__":
         if step % log_interval == 0:
             log_dict = dict(
                 loss=loss.item(),
-                grad_norm=get_grad_norm(model) if grad_norm is None else grad_norm,
+                grad_norm=(get_grad_norm(model) if grad_norm is None else grad_norm).item(),
                 lr=optim.param_groups[0]["lr"],
             )
             logger.log(log_dict, step=step)
             pbar.set_postfix(loss=log_dict["loss"])
 
         optim.step()
-        optim.zero_grad()
+        optim.zero_grad(set_to_none=True)
         step += 1
         pbar.update()
         if args.profile and step == 1:
@@ -1,6 +1,5 @@
 import math
 from copy import deepcopy
-from functools import partial
 
 import bitsandbytes as bnb
 import torch
@@ -18,17 +17,87 @@ from subclasses import (
 )
 
 
+class CudaPrefetcher:
+    """Wrap an iterator yielding CPU tensors. H2D copy is issued on a separate stream so that
+    transfer of batch N+1 overlaps with compute of batch N. Batches are staged through a small
+    ring of reusable pinned buffers, so the DataLoader doesn't need pin_memory=True (which pins
+    a fresh buffer per batch).
+    """
+
+    def __init__(self, iterable, n_buffers: int = 2) -> None:
+        self.iterator = iter(iterable)
+        self.stream = torch.cuda.Stream()
+        self.buffers = [None] * n_buffers
+        self.events = [None] * n_buffers
+        self.buf_idx = 0
+        self._preload()
+
+    def _preload(self):
+        batch = next(self.iterator, None)
+        if batch is None:
+            self._next_batch = None
+            return
+
+        idx = self.buf_idx
+        if self.events[idx] is not None:
+            # make sure the previous H2D copy from this pinned buffer finished before overwriting
+            self.events[idx].synchronize()
+        if self.buffers[idx] is None:
+            self.buffers[idx] = [torch.empty_like(x, pin_memory=True) for x in batch]
+        for buf, x in zip(self.buffers[idx], batch):
+            buf.copy_(x)
+
+        with torch.cuda.stream(self.stream):
+            self._next_batch = [buf.cuda(non_blocking=True) for buf in self.buffers[idx]]
+        self.events[idx] = torch.cuda.Event()
+        self.events[idx].record(self.stream)
+        self.buf_idx = (idx + 1) % len(self.buffers)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._next_batch is None:
+            raise StopIteration
+        torch.cuda.current_stream().wait_stream(self.stream)
+        batch = self._next_batch
+        for x in batch:
+            x.record_stream(torch.cuda.current_stream())
+        self._preload()
+        return batch
+
+
 @torch.no_grad()
-def get_grad_norm(model: nn.Module):
-    grad_norm_sq = sum(p.grad.square().sum() for p in model.parameters() if p.grad is not None)
-    if hasattr(grad_norm_sq, "full_tensor"):
-        grad_norm_sq = grad_norm_sq.full_tensor()
-    return grad_norm_sq.item() ** 0.5
+def get_grad_norm(model: nn.Module) -> Tensor:
+    # multi-tensor-apply kernel + a single reduction, same pattern as clip_grad_norm_.
+    # return a 0-dim tensor instead of float so callers decide when to sync.
+    grads = [p.grad for p in model.parameters() if p.grad is not None]
+    grad_norm = torch.linalg.vector_norm(torch.stack(torch._foreach_norm(grads, 2.0)), 2.0)
+    if hasattr(grad_norm, "full_tensor"):
+        grad_norm = grad_norm.full_tensor()
+    return grad_norm
+
+
+# registry instead of eval() so we can attach per-optimizer default kwargs.
+# NOTE: don't default fused=True here. the quantized-training subclasses only implement the
+# single-tensor optimizer ops, and an explicit fused=True bypasses the fallback that
+# _default_to_fused_or_foreach provides for non-plain tensors.
+OPTIM_REGISTRY = {
+    "torch.optim.Adam": torch.optim.Adam,
+    "torch.optim.AdamW": torch.optim.AdamW,
+}
 
 
 def get_optimizer(optim: str, model: nn.Module, lr: float, weight_decay: float, **kwargs):
-    allowed = dict(torch=torch, low_bit_optim=low_bit_optim, bnb=bnb, other_optim=other_optim, partial=partial)
-    optim_cls = eval(optim, allowed)
+    if optim in OPTIM_REGISTRY:
+        optim_cls = OPTIM_REGISTRY[optim]
+    else:
+        # resolve dotted names e.g. "low_bit_optim.AdamW8bit" via attribute walk
+        namespaces = dict(torch=torch, low_bit_optim=low_bit_optim, bnb=bnb, other_optim=other_optim)
+        module, *attrs = optim.split(".")
+        optim_cls = namespaces[module]
+        for attr in attrs:
+            optim_cls = getattr(optim_cls, attr)
     return optim_cls(model.parameters(), lr=lr, weight_decay=weight_decay, **kwargs)
 
 